@@ -2,6 +2,7 @@
 # James Taddei
 
 import pandas as pd
+from pandas.api.types import union_categoricals
 from nba_api.stats.endpoints import (
     leaguegamelog,
     boxscoreadvancedv3,
@@ -12,16 +13,44 @@ from nba_api.stats.endpoints import (
     PlayerGameLogs,
     commonteamroster,
 )
+from nba_api.stats.library.http import NBAStatsHTTP, NBAStatsResponse
 from nba_api.stats.static import teams
 from datetime import date
-import time
+from functools import wraps
+from pathlib import Path
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ReadTimeout
+from urllib3.util.retry import Retry
 from json.decoder import JSONDecodeError
 
 
+# Decorator that saves each fetched box score to .cache/{data_type}/{game_id}.parquet
+# Box scores for finished games don't change, so if the file is already there we read it instead of calling the API
+def cache_box_score(fetch):
+    @wraps(fetch)
+    def wrapper(self, game_id, data_type):
+        cache_path = Path(f".cache/{data_type}/{game_id}.parquet")
+        if cache_path.exists():
+            return pd.read_parquet(cache_path, engine="pyarrow")
+
+        team_stats = fetch(self, game_id, data_type)
+
+        # Write to a temporary file first so a crash mid-write doesn't leave a broken file in the cache
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_suffix(".tmp")
+        team_stats.to_parquet(temp_path, engine="pyarrow", compression="zstd", index=False)
+        temp_path.replace(cache_path)
+        return team_stats
+
+    return wrapper
+
+
 # Use this class to fetch data for a given season
 class NBADataFetcher:
-    def __init__(self, season):
+    def __init__(self, season, max_concurrent_requests=4):
         # Specify the season we want to collect data for
         # Season must be of format "YYYY-YY" (i.e., "2023-24")
         self.season = season
@@ -33,6 +62,15 @@ class NBADataFetcher:
             team["id"]: team["abbreviation"] for team in teams.get_teams()
         }
 
+        # One session is shared by every box score request so connections stay open between calls
+        self.session = self.create_session()
+
+        # Limits how many box score requests can be sent at once
+        self.rate_limiter = threading.Semaphore(max_concurrent_requests)
+
+        # Set when we stop fetching (Ctrl+C or an error) so worker threads give up instead of retrying
+        self.stop_event = threading.Event()
+
         # Fetch and process game logs
         game_logs = self.fetch_league_game_logs()
         processed_game_logs = self.process_game_logs(game_logs)
@@ -49,25 +87,33 @@ class NBADataFetcher:
             season=self.season, season_type_all_star="Playoffs"
         )
 
+        # Only keep the columns we use when processing the logs
+        columns = ["GAME_ID", "TEAM_ID", "TEAM_ABBREVIATION", "GAME_DATE", "MATCHUP", "PTS"]
+
         # Concatenates the regular season games and playoff games and returns a pandas DataFrame containing these
         return pd.concat(
-            [game_log.get_data_frames()[0], playoff_log.get_data_frames()[0]]
+            [game_log.get_data_frames()[0][columns], playoff_log.get_data_frames()[0][columns]]
         )
     
     def process_game_logs(self, game_logs):
-        # Reformat dates as date object
-        game_logs["GAME_DATE"] = game_logs["GAME_DATE"].apply(
-            # For each date in GAME_DATE: split it by dashes, use map to make each an int, apply date function
-            lambda x: date(*map(int, x.split("-")))
-        )
+        # Reformat dates as date object. Giving the format lets pandas parse the whole column at once
+        game_logs["GAME_DATE"] = pd.to_datetime(game_logs["GAME_DATE"], format="%Y-%m-%d").dt.date
 
-        # Filters out logs that could cause errors
-        game_logs = game_logs[game_logs["GAME_DATE"] != date.today()] # games from today may be incomplete
-        game_logs = game_logs.drop_duplicates(subset=["GAME_ID","TEAM_ID"]) # removes duplicates
+        # There are only a handful of teams, so store the repeated strings as categories
+        game_logs["TEAM_ABBREVIATION"] = game_logs["TEAM_ABBREVIATION"].astype("category")
 
-        # Home logs include "vs." in matchup while away games use "@"
-        home_logs = game_logs[game_logs["MATCHUP"].str.contains(" vs. ").copy()]
-        away_logs = game_logs[game_logs["MATCHUP"].str.contains(" @ ").copy()]
+        # Filters out logs that could cause errors
+        # Games from today may be incomplete, and duplicates are found by hashing only the game and team ids
+        # Both checks are combined into one mask so the logs are only filtered once
+        not_today = game_logs["GAME_DATE"] != date.today()
+        not_duplicate = ~game_logs.duplicated(subset=["GAME_ID","TEAM_ID"])
+        game_logs = game_logs[not_today & not_duplicate]
+
+        # Home logs include "vs." in matchup while away games use "@", so every log that isn't home is away
+        # Matchups look like "BOS vs. NYK" or "BOS @ NYK", so we only need to check the character after the abbreviation
+        is_home = game_logs["MATCHUP"].str.get(4) == "v"
+        home_logs = game_logs[is_home]
+        away_logs = game_logs[~is_home]
 
         # Prepare home and away logs for merging
         home_logs = home_logs.rename(columns={
@@ -99,10 +145,16 @@ class NBADataFetcher:
     # data_type can be "advanced", "traditional", "misc", "hustle", "track"
     # These data types represent different endpoints we call to collect data
     # We call 5 different ones because each provides different statistics about the team's performance in that game
+    @cache_box_score
     def fetch_box_score(self, game_id, data_type):
         max_retries = 10
         wait_seconds = 0.1
+        max_timeouts = 3 # timeouts in a row before we assume the session's connections have gone bad
+        timeouts = 0
         for attempt in range(max_retries):
+            if self.stop_event.is_set():
+                raise RuntimeError("Fetching was stopped")
+
             # Use try block in case of API exception
             try:
                 # For advanced, traditional, and miscellaneous box score API calls, we need to specify extra parameters
@@ -114,6 +166,7 @@ class NBADataFetcher:
                         "range_type": 0,
                         "start_period": 0,
                         "start_range": 0,
+                        "get_request": False, # we send the request ourselves through our session
                     }
 
                     # Call the correct API with the parameters we specified. ** operator unpacks params to be an arg list
@@ -126,121 +179,201 @@ class NBADataFetcher:
                 # For hustle and track box score API calls, we only need to specify the game_id we want
                 else:
                     if data_type == "hustle":
-                        box_score = boxscorehustlev2.BoxScoreHustleV2(game_id)
+                        box_score = boxscorehustlev2.BoxScoreHustleV2(game_id, get_request=False)
                     else:
-                        box_score = boxscoreplayertrackv3.BoxScorePlayerTrackV3(game_id)
+                        box_score = boxscoreplayertrackv3.BoxScorePlayerTrackV3(game_id, get_request=False)
+
+                self.send_box_score_request(box_score)
 
                 # Isolate the team data from the whole box score
                 team_stats = box_score.team_stats.get_data_frame()
+                team_stats["teamTricode"] = team_stats["teamTricode"].astype("category")
                 return team_stats
 
             # We will fill this in later to handle different kinds of exceptions that may arise when calling the APIs
             except JSONDecodeError as e:
-                if attempt < max_retries:
+                timeouts = 0 # we got a response, so the timeouts are no longer in a row
+                if attempt < max_retries - 1:
                     print(f"JSONDecode Error Occurred. Retying for the {attempt+1} / {max_retries} attempt")
-                    time.sleep(wait_seconds)
+                    self.stop_event.wait(wait_seconds) # wakes up early if we're stopping
                 else:
                     print("Fetching this game failed. Skipping")
                     raise
 
+            except ReadTimeout as e:
+                timeouts += 1
+                if timeouts >= max_timeouts:
+                    print("Repeated timeouts. Clearing session")
+                    self.clear_session()
+                    timeouts = 0
+
+                if attempt < max_retries - 1:
+                    print(f"Request timed out. Retying for the {attempt+1} / {max_retries} attempt")
+                    self.stop_event.wait(wait_seconds) # wakes up early if we're stopping
+                else:
+                    print("Fetching this game failed. Skipping")
+                    raise
+
+    # Creates a session that keeps connections alive and retries requests that fail with a server error
+    # Read timeouts are not retried here so fetch_box_score can see them and clear the session if needed
+    def create_session(self):
+        session = requests.Session()
+        retries = Retry(
+            total=3,
+            read=False,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retries)
+        session.mount("https://", adapter)
+        return session
+
+    # Swaps in a fresh session and closes the old one so its pooled connections aren't leaked
+    # Closing doesn't cut off requests other threads already have in flight, their connections are just closed when they finish
+    def clear_session(self):
+        old_session = self.session
+        self.session = self.create_session()
+        old_session.close()
+
+    # nba_api sends every request with requests.get, which opens a new connection each time
+    # This sends the endpoint's request through our session instead, then lets the endpoint parse the response
+    # Each request holds a spot in the rate limiter, and the short sleep before giving up the spot keeps us from going over NBA.com's rate limits
+    def send_box_score_request(self, box_score):
+        with self.rate_limiter:
+            # Threads waiting on the rate limiter may get a spot after we've started stopping
+            if self.stop_event.is_set():
+                raise RuntimeError("Fetching was stopped")
+
+            response = self.session.get(
+                url=NBAStatsHTTP.base_url.format(endpoint=box_score.endpoint),
+                params=sorted(box_score.parameters.items()), # nba_api sorts the parameters, some requests depend on it
+                headers=box_score.headers or NBAStatsHTTP.headers,
+                timeout=box_score.timeout,
+            )
+            self.stop_event.wait(0.6)
+        contents = NBAStatsHTTP().clean_contents(response.text)
+        box_score.nba_response = NBAStatsResponse(response=contents, status_code=response.status_code, url=response.url)
+        box_score.load_response()
+
     def find_existing_data(self):
         data_types = ["advanced", "hustle", "misc", "track", "traditional"]
+        self.existing_game_ids = {}
 
         for data_type in data_types:
             try:
                 # Read data for the data type and store it in an member variable
-                existing_data = pd.read_csv(f"{self.season}_{data_type}_stats.csv")
+                existing_data = pd.read_parquet(f"{self.season}_{data_type}_stats.parquet", engine="pyarrow")
                 setattr(self, f"existing_{data_type}_stats", existing_data)
             except:
-                setattr(self, f"existing_{data_type}_stats", pd.DataFrame())
+                existing_data = pd.DataFrame()
+                setattr(self, f"existing_{data_type}_stats", existing_data)
+
+            # Keep the game ids we already have in a set so checking for a game doesn't rescan the data every time
+            if existing_data.empty:
+                self.existing_game_ids[data_type] = set()
+            else:
+                self.existing_game_ids[data_type] = set(existing_data["gameId"].astype(int).unique())
 
     def data_exists(self, game_id, data_type):
-        existing_data = getattr(self, f"existing_{data_type}_stats")
-        return (not existing_data.empty) and (int(game_id) in existing_data["gameId"].unique())
+        return int(game_id) in self.existing_game_ids[data_type]
     
     def concatenate_and_save(self, data_type, new_data_list):
         existing_data = getattr(self, f"existing_{data_type}_stats")
 
-        if (not existing_data.empty) and (len(new_data_list) != 0): # existing and new data
-            combined_data = pd.concat([existing_data, pd.concat(new_data_list, ignore_index=True)], ignore_index=True)
-        elif len(new_data_list) == 0: # no new data, but have existing data
-            combined_data = existing_data
-        else: # no existing data, have new data
-            combined_data = pd.concat(new_data_list, ignore_index=True)
+        # With no new data the file on disk is already up to date, so don't write it again
+        if len(new_data_list) == 0:
+            return
+
+        # Existing data (if any) and new data are concatenated together in one go
+        frames = ([existing_data] if not existing_data.empty else []) + new_data_list
+
+        # Concatenating categories that don't match gives back strings, so give every frame the same team categories first
+        team_categories = union_categoricals([frame["teamTricode"].astype("category") for frame in frames]).categories
+        for frame in frames:
+            frame["teamTricode"] = frame["teamTricode"].astype("category").cat.set_categories(team_categories)
+
+        combined_data = pd.concat(frames, ignore_index=True, copy=False)
 
-        combined_data.to_csv(f"{self.season}_{data_type}_stats.csv")
+        # Games that failed before are fetched on a later run and end up after everything that was already saved
+        # The preprocessor's running averages depend on row order, so put the rows back in game log order (sorted by date)
+        game_order = {game_id: position for position, game_id in enumerate(self.processed_game_logs["gameId"])}
+        combined_data = combined_data.sort_values(
+            by="gameId", key=lambda game_ids: game_ids.map(game_order), kind="stable", ignore_index=True
+        )
+        combined_data.to_parquet(f"{self.season}_{data_type}_stats.parquet", engine="pyarrow", compression="zstd", index=False)
+
+    # Saves the new box scores for every data type
+    # Box scores finish in whatever order the threads get to them, but the preprocessor's running averages depend on row order
+    # So each list is built in the order of box_score_requests, which follows the game logs (sorted by date)
+    def save_all_data(self, box_score_requests, box_scores):
+        stats_lists = {data_type: [] for data_type in ["advanced", "hustle", "misc", "track", "traditional"]}
+        for game_id, data_type in box_score_requests:
+            if (game_id, data_type) in box_scores:
+                stats_lists[data_type].append(box_scores[(game_id, data_type)])
+
+        for data_type, stats_list in stats_lists.items():
+            self.concatenate_and_save(data_type, stats_list)
     
-    def fetch_and_save_all_data(self):
-        game_counter = 0
-        game_logs = self.fetch_league_game_logs()
-        game_logs = self.process_game_logs(game_logs)
-        game_logs.to_csv(f"{self.season}_all_games.csv", index=False)
+    def fetch_and_save_all_data(self, max_workers=8):
+        game_logs = self.processed_game_logs # already fetched and processed when the fetcher was created
+        game_logs.to_parquet(f"{self.season}_all_games.parquet", engine="pyarrow", compression="zstd", index=False)
 
         game_ids = game_logs["gameId"].unique()
         self.find_existing_data()
-        (advanced_stats_list, hustle_stats_list, misc_stats_list, track_stats_list, traditional_stats_list) = ([], [], [], [], [])
-
-        for game_id in game_ids:
-            game_counter += 1
-            if game_counter % 10 == 0:
-                print(f"{game_counter} / {len(game_ids)}")
-
-            try:
-                advanced_stats_exist = self.data_exists(game_id, "advanced")
-                if not advanced_stats_exist: # Only add box score if it's not already in the list
-                    advanced_box_score = self.fetch_box_score(game_id, "advanced")
-                    advanced_stats_list.append(advanced_box_score)
-
-                hustle_stats_exist = self.data_exists(game_id, "hustle")
-                if not hustle_stats_exist: # Only add box score if it's not already in the list
-                    hustle_box_score = self.fetch_box_score(game_id, "hustle")
-                    hustle_stats_list.append(hustle_box_score)
-
-                misc_stats_exist = self.data_exists(game_id, "misc")
-                if not misc_stats_exist: # Only add box score if it's not already in the list
-                    misc_box_score = self.fetch_box_score(game_id, "misc")
-                    misc_stats_list.append(misc_box_score)
-
-                track_stats_exist = self.data_exists(game_id, "track")
-                if not track_stats_exist: # Only add box score if it's not already in the list
-                    track_box_score = self.fetch_box_score(game_id, "track")
-                    track_stats_list.append(track_box_score)
-
-                traditional_stats_exist = self.data_exists(game_id, "traditional")
-                if not traditional_stats_exist: # Only add box score if it's not already in the list
-                    traditional_box_score = self.fetch_box_score(game_id, "traditional")
-                    traditional_stats_list.append(traditional_box_score)
-                
-            except KeyboardInterrupt: # Ctrl+C in terminal while saving
-                print("Caught KeyboardInterrupt, saving files")
-                # Saves everything before the program terminates, then rethrows the error
-                self.concatenate_and_save("advanced", advanced_stats_list)
-                self.concatenate_and_save("hustle", hustle_stats_list)
-                self.concatenate_and_save("misc", misc_stats_list)
-                self.concatenate_and_save("track", track_stats_list)
-                self.concatenate_and_save("traditional", traditional_stats_list)
-                raise
+        data_types = ["advanced", "hustle", "misc", "track", "traditional"]
+        box_scores = {} # maps (game_id, data_type) to the fetched box score
+
+        # Only request box scores that we don't already have saved
+        box_score_requests = [
+            (game_id, data_type)
+            for game_id in game_ids
+            for data_type in data_types
+            if not self.data_exists(game_id, data_type)
+        ]
+
+        # The requests are network-bound, so we send them from a pool of threads sharing one session
+        self.stop_event.clear()
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {
+            executor.submit(self.fetch_box_score, game_id, data_type): (game_id, data_type)
+            for game_id, data_type in box_score_requests
+        }
 
-            except JSONDecodeError as e:
-                print("Failed to fetch data, skipping game")
-
-            except Exception as e:
-                print(f"Caught unexpected exception: {e}, saving files")
-                # Saves everything before the program terminates, then rethrows the error
-                self.concatenate_and_save("advanced", advanced_stats_list)
-                self.concatenate_and_save("hustle", hustle_stats_list)
-                self.concatenate_and_save("misc", misc_stats_list)
-                self.concatenate_and_save("track", track_stats_list)
-                self.concatenate_and_save("traditional", traditional_stats_list)
-                raise
+        request_counter = 0
+        try:
+            for future in as_completed(futures):
+                request_counter += 1
+                if request_counter % 50 == 0:
+                    print(f"{request_counter} / {len(futures)}")
+
+                game_id, data_type = futures[future]
+                try:
+                    box_scores[(game_id, data_type)] = future.result()
+                except (JSONDecodeError, ReadTimeout): # only skip this box score, the rest of the pool keeps going
+                    print(f"Failed to fetch {data_type} data for game {game_id}, skipping")
+
+        except KeyboardInterrupt: # Ctrl+C in terminal while saving
+            print("Caught KeyboardInterrupt, saving files")
+            self.stop_event.set() # stops requests that are already running from retrying
+            executor.shutdown(wait=False, cancel_futures=True)
+            # Saves everything before the program terminates, then rethrows the error
+            self.save_all_data(box_score_requests, box_scores)
+            raise
+
+        except Exception as e:
+            print(f"Caught unexpected exception: {e}, saving files")
+            self.stop_event.set() # stops requests that are already running from retrying
+            executor.shutdown(wait=False, cancel_futures=True)
+            # Saves everything before the program terminates, then rethrows the error
+            self.save_all_data(box_score_requests, box_scores)
+            raise
+
+        executor.shutdown()
 
         # Save data
         print(f"Data fetched successfully, saving data for {self.season}")
-        self.concatenate_and_save("advanced", advanced_stats_list)
-        self.concatenate_and_save("hustle", hustle_stats_list)
-        self.concatenate_and_save("misc", misc_stats_list)
-        self.concatenate_and_save("track", track_stats_list)
-        self.concatenate_and_save("traditional", traditional_stats_list)
+        self.save_all_data(box_score_requests, box_scores)
 
 if __name__ == "__main__":
     # Specify the seasons we want to collect data for
@@ -5,17 +5,23 @@ import pandas as pd
 import random
 import numpy as np
 import matplotlib.pyplot as plt
-from xgboost import XGBRegressor
-from sklearn.preprocessing import StandardScalar
+import xgboost as xgb
+from joblib import Parallel, delayed
+from nba_api.stats.static import teams
+from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import mean_absolute_error, mean_squared_error
 import pickle
 
+# XGBoost encodes categories by their integer codes, not their labels, so every frame we train or predict on has to use the same team categories
+# Cast team columns to this dtype anywhere features are built, including frames built for predictions
+TEAM_CATEGORIES = pd.CategoricalDtype(sorted(team["abbreviation"] for team in teams.get_teams()))
+
 def load_data():
-    df_games = pd.read_csv("all_games.csv", index_col=0)
+    df_games = pd.read_parquet("all_games.parquet")
     df_games["GAME_DATE"] = pd.to_datetime(df_games["GAME_DATE"])
     df_games["spread"] = (df_games["HOME_TEAM_PTS"] - df_games["AWAY_TEAM_PTS"]).astype(int)
 
-    df_averages = pd.read_csv("all_team_averages.csv", index_col=0)
+    df_averages = pd.read_parquet("all_team_averages.parquet")
     df_averages = df_averages.drop(columns=["date"])
     df_averages = df_averages[df_averages["game_count"] >= 10] # remove first 9 games from stats (more outliers)
 
@@ -26,41 +32,42 @@ def generate_home_away_data(df_games, df_averages):
     df_home = pd.merge(df_averages, df_games[["gameId", "HOME_TEAM_ABBREVIATION", "spread"]], left_on=["gameId", "teamTricode"], right_on=["gameId", "HOME_TEAM_ABBREVIATION"], how="inner")
     df_away = pd.merge(df_averages, df_games[["gameId", "AWAY_TEAM_ABBREVIATION", "spread"]], left_on=["gameId", "teamTricode"], right_on=["gameId", "AWAY_TEAM_ABBREVIATION"], how="inner")
 
-    df_home = df_home.sort_values(by="gameId")
-    df_away = df_away.sort_values(by="gameId")
+    # Index both by game so they can be joined on the index instead of merged on a column
+    df_home = df_home.set_index("gameId").sort_index()
+    df_away = df_away.set_index("gameId").sort_index()
     df_games = df_games.sort_values(by="gameId")
 
     df_home = df_home.drop(columns=["HOME_TEAM_ABBREVIATION"])
     df_away = df_away.drop(columns=["AWAY_TEAM_ABBREVIATION", "spread", "playoff"])
 
-    df_home = pd.get_dummies(df_home, columns=["teamTricode"])
-    df_away = pd.get_dummies(df_away, columns=["teamTricode"])
+    # XGBoost splits on categories directly, so we keep one team column instead of a dummy column per team
+    df_home["teamTricode"] = df_home["teamTricode"].astype(TEAM_CATEGORIES)
+    df_away["teamTricode"] = df_away["teamTricode"].astype(TEAM_CATEGORIES)
 
-    spread = df_home[["gameId", "spread", "playoff"]]
+    spread = df_home[["spread", "playoff"]]
     df_home = df_home.drop(columns=["spread", "playoff"])
 
     return df_home, df_away, spread
 
 def generate_combined_data(df_home, df_away):
-    df_combined = pd.merge(df_home, df_away, on=["gameId"], how="inner", suffixes=["_home", "_away"])
-    return df_combined
-
-def generate_diff_features(df_home, df_away):
-    df_home = df_home.set_index("gameId")
-    df_away = df_away.set_index("gameId")
+    df_combined = df_home.join(df_away, how="inner", lsuffix="_home", rsuffix="_away")
 
-    # Subtract columns that aren't the team tricode
+    # Home and away columns already line up by row after the join, so subtract them as one block of arrays
     diff_columns = [col for col in df_home.columns if "teamTricode" not in col]
-    diff_features = df_home[diff_columns].sub(df_away[diff_columns], fill_value=0)
-
-    diff_features = diff_features.reset_index()
-    diff_features.columns = ["gameId"] + [f"diff_" for col in diff_features if col != "gamId"]
-    return diff_features
+    home_values = df_combined[[f"{col}_home" for col in diff_columns]].to_numpy()
+    away_values = df_combined[[f"{col}_away" for col in diff_columns]].to_numpy()
+    diff_features = pd.DataFrame(
+        home_values - away_values,
+        columns=[f"diff_{col}" for col in diff_columns],
+        index=df_combined.index
+    )
+
+    df_combined = pd.concat([df_combined, diff_features], axis=1)
+    return df_combined
 
-def generate_full_vector(df_combined, diff_features, spread):
-    df_combined = df_combined.merge(diff_features, on="gameId", how="left")
-    df_combined = pd.merge(df_combined, spread, on="gameId", how="inner")
-    df_combined = df_combined.sort_values(by="gameId")
+def generate_full_vector(df_combined, spread):
+    df_combined = df_combined.join(spread, how="inner")
+    df_combined = df_combined.sort_index()
     return df_combined
 
 def generate_y(df_combined):
@@ -69,53 +76,92 @@ def generate_y(df_combined):
     return y
 
 def split_scale_data(df_games, cutoff_date, df_combined, y):
-    train_mask = df_games[["GAME_DATE"] < pd.to_datetime(cutoff_date)]
-    test_mask = df_games[["GAME_DATE"] >= pd.to_datetime(cutoff_date)]
-
-    train_gameIds = df_games.loc[train_mask, "gameId"].unique()
-    test_gameIds = df_games.loc[test_mask, "gameId"].unique()
+    # Look up each row's game date through the gameId index, then build the masks from those dates
+    game_dates = df_combined.index.map(df_games.set_index("gameId")["GAME_DATE"])
+    train_mask = game_dates < pd.to_datetime(cutoff_date)
+    test_mask = game_dates >= pd.to_datetime(cutoff_date)
 
-    df_train = df_combined[df_combined["gameId"].isin(train_gameIds)]
-    df_test = df_combined[df_combined["gameIds"].isin(test_gameIds)]
-    y_train = y[df_combined["gameIds"].isin(train_gameIds)]
-    y_test = y[df_combined["gameIds"].isin(test_gameIds)]
+    df_train = df_combined[train_mask]
+    df_test = df_combined[test_mask]
+    y_train = y[train_mask]
+    y_test = y[test_mask]
 
-    # FILL IN
+    # Trees split on thresholds, so XGBoost doesn't need the features scaled
+    return df_train, df_test, y_train, y_test
 
 def generate_data(cutoff_date):
     # cutoff_date helps split training and test data. Everything before is training, everything after is test
     df_games, df_average = load_data()
     df_home, df_away, spread = generate_home_away_data(df_games, df_average)
     df_combined = generate_combined_data(df_home, df_away)
-    diff_features = generate_diff_features(df_home, df_away)
-    df_combined = generate_full_vector(df_combined, diff_features, spread)
+    df_combined = generate_full_vector(df_combined, spread)
     y = generate_y(df_combined)
     df_combined = df_combined.drop(columns=["spread"])
+
+    # XGBoost works in float32, so cast the float64 columns now and only copy half as many bytes to the GPU
+    df_combined = df_combined.astype({col: np.float32 for col in df_combined.select_dtypes("float64").columns})
+    y = y.astype(np.float32)
+
     df_train, df_test, y_train, y_test = split_scale_data(df_games, cutoff_date, df_combined, y)
 
     return df_train, df_test, y_train, y_test
 
-df_train, df_test, y_train, y_test = generate_data("2024-08-01")
+def generate_dmatrices(df_train, df_test, y_train, y_test):
+    # Build XGBoost's matrices once so every model we train reuses them instead of converting the DataFrames on each fit
+    # QuantileDMatrix only stores the histogram bins the hist tree method needs. The test matrix reuses the training bins
+    dtrain = xgb.QuantileDMatrix(df_train, label=y_train, enable_categorical=True)
+    dtest = xgb.QuantileDMatrix(df_test, label=y_test, ref=dtrain, enable_categorical=True)
+    return dtrain, dtest
 
-def train_models(n):
+df_train, df_test, y_train, y_test = generate_data("2024-08-01")
+dtrain, dtest = generate_dmatrices(df_train, df_test, y_train, y_test)
+
+def train_model(i, n, params, num_boost_round):
+    print(f"Training model {i} / {n}")
+    xgb_model = xgb.train(
+        params,
+        dtrain,
+        num_boost_round=num_boost_round,
+        evals=[(dtest, "test")],
+        early_stopping_rounds=50,
+        verbose_eval=True
+    )
+
+    # xgb.train keeps the trees built after the best iteration, and Booster.predict would use all of them
+    # Slicing keeps only the trees up to the best iteration, like XGBRegressor.predict did
+    xgb_model = xgb_model[: xgb_model.best_iteration + 1]
+
+    # Save from inside the worker so each model is written as soon as it finishes
+    with open(f"spread_model_{i}.pkl", "wb") as f:
+        pickle.dump(xgb_model, f)
+    return xgb_model
+
+def train_models(n, n_jobs=2):
     num_samples = df_test.shape[0]
 
-    models = []
+    # Pick every model's random hyperparameters up front so the worker threads don't share the random generator
+    trials = []
     for i in range(1, n+1):
-        print(f"Training model {i} / {n}")
-        xgb_model = XGBRegressor(
-            max_depth=random.randint(4,10),
-            learning_rate=random.randrange(5, 20, 1)/1000.0,
-            n_estimators=random.randint(700, 1500),
-            eval_metric="rmse",
-            objective="reg:squarederror",
-            alpha=random.randrange(5, 20, 1)/1000.0,
-            early_stopping_rounds=50,
-            device="cuda"
-        )
-        xgb_model.fit(df_train, y_train, eval_set=[(df_test, y_test)], verbose=True)
-
-        models.append(xgb_model)
-        pickle.diump(xgb_model. open(f"spread_model_{i}.pkl", "wb"))
-
-train_models(5)
\ No newline at end of file
+        params = {
+            "max_depth": random.randint(4,10),
+            "learning_rate": random.randrange(5, 20, 1)/1000.0,
+            "eval_metric": "rmse",
+            "objective": "reg:squarederror",
+            "alpha": random.randrange(5, 20, 1)/1000.0,
+            "tree_method": "hist",
+            "device": "cuda"
+        }
+        trials.append((i, params, random.randint(700, 1500)))
+
+    # XGBoost converts the host-built matrices to its GPU format the first time they're used, without locking them
+    # Training one round first, before the threads start, does that conversion so the threads don't race on it
+    if len(trials) > 0:
+        xgb.train(trials[0][1], dtrain, num_boost_round=1, evals=[(dtest, "test")], verbose_eval=False)
+
+    # xgb.train releases the GIL while training, so with threads one model's setup and evaluation overlap with another's training
+    models = Parallel(n_jobs=n_jobs, backend="threading")(
+        delayed(train_model)(i, n, params, num_boost_round) for i, params, num_boost_round in trials
+    )
+    return models
+
+train_models(5)
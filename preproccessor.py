@@ -3,7 +3,6 @@
 
 import pandas as pd
 import numpy as np
-from datetime import date
 
 class Preproccessor:
     def __init__(self, seasons, span, shift):
@@ -21,19 +20,23 @@ class Preproccessor:
     def load_all_games(self):
         seasons = []
         for season in self.seasons:
-            df_games = pd.read_csv(f"{season}_all_games.csv")
+            df_games = pd.read_parquet(f"{season}_all_games.parquet")
             seasons.append(df_games)
         self.games = pd.concat(seasons)
-        self.games["GAME_DATE"] = self.games["GAME_DATE"].apply(
-            lambda x: date(*map(int, x.split("-")))
-        ) # puts dates in datetime format if they are not already
+        # Each season has its own team categories, so concatenating gives back strings. Convert back to categories
+        self.games["HOME_TEAM_ABBREVIATION"] = self.games["HOME_TEAM_ABBREVIATION"].astype("category")
+        self.games["AWAY_TEAM_ABBREVIATION"] = self.games["AWAY_TEAM_ABBREVIATION"].astype("category")
+        self.games["GAME_DATE"] = pd.to_datetime(
+            self.games["GAME_DATE"], format="%Y-%m-%d"
+        ).dt.date # puts dates in datetime format if they are not already
 
     def load_team_data(self):
         seasons = []
         for season in self.seasons:
-            df_games = pd.read_csv(f"{season}_all_games.csv")
-            df_advanced = pd.read_csv(f"{season}_advanced_stats.csv")[
-                [
+            df_games = pd.read_parquet(f"{season}_all_games.parquet")
+            df_advanced = pd.read_parquet(
+                f"{season}_advanced_stats.parquet",
+                columns=[
                     "gameId",
                     "teamTricode",
                     "estimatedOffensiveRating",
@@ -58,10 +61,11 @@ class Preproccessor:
                     "pacePer40",
                     "possessions",
                     "PIE",
-                ]
-            ]
-            df_traditional = pd.read_csv(f"{season}_traditional_stats.csv")[
-                [
+                ],
+            )
+            df_traditional = pd.read_parquet(
+                f"{season}_traditional_stats.parquet",
+                columns=[
                     "gameId",
                     "teamTricode",
                     "fieldGoalsMade",
@@ -83,10 +87,11 @@ class Preproccessor:
                     "foulsPersonal",
                     "points",
                     "plusMinusPoints",
-                ]
-            ]
-            df_hustle = pd.read_csv(f"{season}_hustle_stats.csv")[
-                [
+                ],
+            )
+            df_hustle = pd.read_parquet(
+                f"{season}_hustle_stats.parquet",
+                columns=[
                     "gameId",
                     "teamTricode",
                     "contestedShots",
@@ -104,10 +109,11 @@ class Preproccessor:
                     "boxOutPlayerTeamRebounds",
                     "boxOutPlayerRebounds",
                     "boxOuts",
-                ]
-            ]
-            df_misc = pd.read_csv(f"{season}_misc_stats.csv")[
-                [
+                ],
+            )
+            df_misc = pd.read_parquet(
+                f"{season}_misc_stats.parquet",
+                columns=[
                     "gameId",
                     "teamTricode",
                     "pointsOffTurnovers",
@@ -120,10 +126,11 @@ class Preproccessor:
                     "oppPointsPaint",
                     "blocksAgainst",
                     "foulsDrawn",
-                ]
-            ]
-            df_tracking = pd.read_csv(f"{season}_track_stats.csv")[
-                [
+                ],
+            )
+            df_tracking = pd.read_parquet(
+                f"{season}_track_stats.parquet",
+                columns=[
                     "gameId",
                     "teamTricode",
                     "distance",
@@ -143,8 +150,8 @@ class Preproccessor:
                     "defendedAtRimFieldGoalsMade",
                     "defendedAtRimFieldGoalsAttempted",
                     "defendedAtRimFieldGoalPercentage",
-                ]
-            ]
+                ],
+            )
 
             merge_columns = ["gameId", "teamTricode"] # PK is a team's performance in a specific game
             merged_df = pd.merge(df_advanced, df_traditional, on=merge_columns, how="inner")
@@ -152,14 +159,13 @@ class Preproccessor:
             merged_df = pd.merge(merged_df, df_misc, on=merge_columns, how="inner")
             merged_df = pd.merge(merged_df, df_tracking, on=merge_columns, how="inner")
             merged_df = merged_df.drop_duplicates()
+            merged_df["teamTricode"] = merged_df["teamTricode"].astype("category") # merging different categories gives back strings
 
             merged_df = pd.merge(
                 merged_df, df_games[["gameId", "GAME_DATE"]], on="gameId", how="inner"
             ) # grab the data of the game because it's not in any merged dataframe\
 
-            merged_df["date"] = merged_df["GAME_DATE"].apply(
-                lambda x: date(*map(int, x.split("-")))
-            )
+            merged_df["date"] = pd.to_datetime(merged_df["GAME_DATE"], format="%Y-%m-%d").dt.date
             merged_df = merged_df.drop(columns = ["GAME_DATE"])
 
             # Adds a new columns for the winner of the game. Works like a functional if (if condition, include first; otherwise, second) 
@@ -185,10 +191,11 @@ class Preproccessor:
             seasons.append(processed_df)
         
         self.team_stats = pd.concat(seasons)
+        self.team_stats["teamTricode"] = self.team_stats["teamTricode"].astype("category")
         self.team_stats = self.team_stats.drop(columns=["HOME_TEAM_ABBREVIATION", "AWAY_TEAM_ABBREVIATION", "winner"])
 
     def preprocess_team_data(self, df):
-        grouped = df.groupby("teamTricode")
+        grouped = df.groupby("teamTricode", observed=True) # only teams that played, not every category
         modified_groups = []
         for _, group in grouped:
             group["game_count"] = (
@@ -260,5 +267,5 @@ if __name__ == "__main__":
     p50.team_stats = pd.merge(p50.team_stats, p10.team_stats, on=common_cols, how="inner")
 
     print("Processing complete, saving data")
-    p50.games.to_csv("all_games.csv")
-    p50.team_stats.to_csv("all_team_averages.csv")
\ No newline at end of file
+    p50.games.to_parquet("all_games.parquet", engine="pyarrow", compression="zstd", index=False)
+    p50.team_stats.to_parquet("all_team_averages.parquet", engine="pyarrow", compression="zstd", index=False)
\ No newline at end of file